@@ -5,6 +5,11 @@ import os
 def get_logger(name, filename=None, foldername="Logs"):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    # Handlers are only attached once, no matter how often this is called
+    if logger.handlers:
+        return logger
     
     if not os.path.exists(foldername):
         os.makedirs(foldername)
@@ -1,21 +1,59 @@
+from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
 import enum
-import json
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-import time
-from typing import Any, Dict, List
-from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+import shutil
+from typing import Any, Dict, List, Optional
+from urllib.parse import urljoin as _urljoin
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import soupsieve as sv
 
 from logger import get_logger
 
 
 LOG = get_logger(__name__)
 
+# Memoized urljoin. Every unit joins against its own profile url, so the
+# scraper itself rarely hits the cache; it only helps repeated joins.
+urljoin = lru_cache(maxsize=4096)(_urljoin)
+
 BASE_URL = "https://www.bravefrontier.jp/library/bf1/bf1_list.php"
 SAVE_PATH = Path("./db/bf1_units/")
+MAX_WORKERS = 16  # Number of units scraped at the same time
+ASSET_WORKERS = 16  # Number of assets downloaded at the same time across all units
+CHUNK_SIZE = 64 * 1024  # Bytes copied at a time when streaming assets to disk
 if not SAVE_PATH.exists(): SAVE_PATH.mkdir(parents=True, exist_ok=True)
 
+# Shared session so keep-alive connections to the site are reused
+# instead of opening a new connection for every page and asset.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    # Every unit and asset worker can hold a connection at the same time
+    pool_maxsize=MAX_WORKERS + ASSET_WORKERS,
+    # Back off and retry when the site throttles or fails under concurrent load
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+    ),
+))
+SESSION.headers.update({
+    "User-Agent": "Mozilla/5.0 (compatible; Brave-Frontier-Scraper)"
+})
+
+# Only the parts of a unit's profile page that are actually read get parsed
+UNIT_PAGE_STRAINER = SoupStrainer(["div", "article"], attrs={"class": [
+    "unit_detail_number", "unit_detail_name", "rank", "sex", "unit_gif", "unit_text"
+]})
+
 class UnitElements(enum.Enum):
     Fire = 1
     Water = 2
@@ -26,20 +64,47 @@ class UnitElements(enum.Enum):
 
     @classmethod
     def has_value(self, value) -> bool:
-        return any(elem.value == value for elem in UnitElements)
+        return value in _UNIT_ELEMENT_VALUES
+
+_UNIT_ELEMENT_VALUES = frozenset(elem.value for elem in UnitElements)
 
 
 class UnitPage:
-    def __init__(self, url:str):
+    __slots__ = (
+        "base_url", "_soup", "_sections", "uid", "icon", "name", "series",
+        "attribute", "rank", "sex", "animations", "unit_text",
+    )
+
+    # Every section of the page that holds unit data, wherever it is nested
+    _SECTIONS = sv.compile(
+        'div[class="unit_detail_number"], div[class="unit_detail_name"], div[class="rank"], '
+        'div[class="sex"], div[class="unit_gif"], article[class="unit_text"]'
+    )
+
+    # CSS selectors are compiled once and shared by every page. They are
+    # matched relative to a single section of the page, not the whole page.
+    _SELECTORS = {name: sv.compile(css) for name, css in {
+        "number": ':scope > span[class="number"]',
+        "series": ':scope > span[class="series"]',
+        "name": ':scope > p[class="name"]',
+        "attribute": ':scope > div[class="zokusei"] > img[src]',
+        "image": ':scope > img[src]',
+    }.items()}
+
+    def __init__(self, url:str, page:bytes, *, uid:Optional[str]=None, icon:Optional[str]=None):
         self.base_url = url
 
-        req = requests.get(self.base_url)
-        page = req.content
+        self._soup = BeautifulSoup(page, "lxml", parse_only=UNIT_PAGE_STRAINER)
 
-        self._soup = BeautifulSoup(page, "html.parser")
+        # Group the sections by class in one walk of the page instead of
+        # searching the whole page once per attribute.
+        self._sections = defaultdict(list)
+        for section in self._SECTIONS.iselect(self._soup):
+            self._sections[" ".join(section.get("class", []))].append(section)
 
-        self.uid = None
-        self.icon = None
+        # Values already known from the unit list are kept as is
+        self.uid = uid
+        self.icon = icon
         self.name = None
         self.series = None
         self.attribute = None
@@ -50,62 +115,74 @@ class UnitPage:
 
         self.gather_data()
 
+    @classmethod
+    def from_url(cls, url:str, session:Optional[requests.Session]=None, **known) -> "UnitPage":
+        '''Downloads the unit's profile page and parses it.'''
+        req = (session or SESSION).get(url)
+        req.raise_for_status()
+        return cls(url, req.content, **known)
+
+    def _select_one(self, section:str, selector:str) -> Optional[Tag]:
+        '''Returns the first match of a selector within a section of the page.'''
+        for section_tag in self._sections[section]:
+            tag = self._SELECTORS[selector].select_one(section_tag)
+            if tag:
+                return tag
+        return None
+
     def to_json(self) -> Dict[str, Any]:
         '''Returns all public attributes in a json-readable format.'''
-        return {k:val for k,val in self.__dict__.items() if not k.startswith("_")}
+        return {k:getattr(self, k) for k in self.__slots__ if not k.startswith("_")}
 
     def get_unit_id(self) -> str:
         '''Grabs the unit's id.'''
-        if not self.uid:
-            id_tag = self._soup.select_one('div[class="unit_detail_number"] > span[class="number"]')
-            if id_tag:
-                self.uid = id_tag.text.strip().lstrip("No.")
-        
+        if self.uid:
+            return self.uid
+
+        id_tag = self._select_one("unit_detail_number", "number")
+        if id_tag:
+            self.uid = id_tag.text.strip().removeprefix("No.")
+
         return self.uid
 
     def get_unit_name(self) -> str:
         '''Grabs the unit's name.'''
-        if not self.name:
-            name_tag = self._soup.select_one('div[class="unit_detail_name"] > p[class="name"]')
-            self.name = name_tag.text.strip()
+        name_tag = self._select_one("unit_detail_name", "name")
+        self.name = name_tag.text.strip()
 
         return self.name
 
     def get_unit_series(self) -> str:
         '''Grabs what series the unit belonged to.'''
-        if not self.series:
-            series_tag = self._soup.select_one('div[class="unit_detail_number"] > span[class="series"]')
-            if series_tag:  # There are some units that do not belong to a series.
-                self.series = series_tag.text.strip().lstrip("≪").rstrip("≫")
-        
+        series_tag = self._select_one("unit_detail_number", "series")
+        if series_tag:  # There are some units that do not belong to a series.
+            self.series = series_tag.text.strip().removeprefix("≪").removesuffix("≫")
+
         return self.series
 
     def get_unit_attribute(self) -> str:
         '''Grabs the unit's attribute.'''
-        if not self.attribute:
-            attr_tag = self._soup.select_one('div[class="unit_detail_name"] > div[class="zokusei"] > img[src]')
-            attribute = attr_tag.get("src")[-5]
-            # if attribute in UnitElements
-            if UnitElements.has_value(int(attribute)):
-                self.attribute = UnitElements(int(attribute)).name
+        attr_tag = self._select_one("unit_detail_name", "attribute")
+        attribute = attr_tag.get("src")[-5]
+        # if attribute in UnitElements
+        if UnitElements.has_value(int(attribute)):
+            self.attribute = UnitElements(int(attribute)).name
 
         return self.attribute
     
     def get_unit_rank(self) -> int:
         '''Grabs the unit's rank.'''
-        if not self.rank:
-            rank_tag = self._soup.select_one('div[class="rank"] > img[src]')
-            if rank_tag:
-                self.rank = rank_tag.get("src")[-5]
+        rank_tag = self._select_one("rank", "image")
+        if rank_tag:
+            self.rank = rank_tag.get("src")[-5]
 
         return self.rank
     
     def get_unit_sex(self) -> str:
         '''Grabs the unit's sex.'''
-        if not self.sex:
-            sex_tag = self._soup.select_one('div[class="sex"] > img[src]')
-            if sex_tag:
-                self.sex = sex_tag.get("src").split("_")[-1].replace(".png", "")
+        sex_tag = self._select_one("sex", "image")
+        if sex_tag:
+            self.sex = sex_tag.get("src").split("_")[-1].replace(".png", "")
 
         return self.sex
     
@@ -113,24 +190,18 @@ class UnitPage:
     def get_unit_animations(self) -> List[str]:
         '''Grabs a list of urls containing the unit animations
         (default, idle, and attack).'''
-        if (len(self.animations) == 3) or (len(self.animations) != 0):
-            return self.animations
-        else:
-            animation_tags = self._soup.select('div[class="unit_gif"] > img[src]')
-            self.animations = [urljoin(self.base_url, animation.get("src")) for animation in animation_tags]
-            return self.animations
+        # Only the first three images are animations; stop matching after them
+        animation_tags = islice((tag for section_tag in self._sections["unit_gif"]
+                                 for tag in self._SELECTORS["image"].iselect(section_tag)), 3)
+        self.animations = [urljoin(self.base_url, animation.get("src")) for animation in animation_tags]
+        return self.animations
 
     def get_unit_text(self) -> str:
         '''Grabs the unit's description.'''
-        if self.unit_text:
-            return self.unit_text
-        else:
-            text_tag = self._soup.select_one('article[class="unit_text"]')
-            if text_tag:
-                self.unit_text = text_tag.text
-                return text_tag.text
-            else:
-                return self.unit_text
+        text_tags = self._sections["unit_text"]
+        if text_tags:
+            self.unit_text = text_tags[0].text
+        return self.unit_text
 
     def gather_data(self) -> None:
         '''Finds all data for each respective attribute.'''
@@ -144,65 +215,115 @@ class UnitPage:
         self.get_unit_text()
 
 
-def main() -> None:
-
-    req = requests.get(BASE_URL)
-    time.sleep(0.5)
-    resp = req.content
-
-    _soup = BeautifulSoup(resp, "html.parser")
-
-    # Get all tags for each Brave Frontier unit
-    for unit_tag in _soup.select('ul[class="unit_list"] > li'):
-
-        uid = unit_tag.select_one('span').text.lstrip("No.")
-
-        # Create a path to store unit data
-        unit_folder = SAVE_PATH / uid
-        unit_folder.mkdir(exist_ok=True)
-
-        # Skip existing entries
-        if (unit_folder / "data.json").exists():
-            LOG.warning(f"{uid} already exists. Brave Frontier unit skipped.")
-            continue
-
-        # Get url to the unit's profile
-        link_tag = unit_tag.select_one('a[href^="bf"]')
-        link_to_profile = urljoin(BASE_URL, link_tag.get("href"))
-
-        LOG.info(f"Downloading unit {uid} profile")
-        unit = UnitPage(link_to_profile)
-
-        # Add unit icon to unit info
-        unit_icon_tag = link_tag.select_one('img[src]')
-        if unit_icon_tag:
-            unit_icon = unit_icon_tag.get("src")
-            unit.icon = unit_icon
+def download_asset(url:str, folder:Path) -> None:
+    '''Streams a single asset straight into the given folder.'''
+    asset_filename = Path(url).name
+
+    LOG.debug("Downloading <%s> to: <%s>", asset_filename, folder)
+
+    # Write to a temporary file first so an interrupted download is never
+    # mistaken for a finished asset on the next run
+    partial_file = folder / f"{asset_filename}.part"
+    with SESSION.get(url, stream=True) as img_req:
+        # Never save an error page under the asset's name
+        img_req.raise_for_status()
+        img_req.raw.decode_content = True
+        with partial_file.open("wb+") as outfile:
+            shutil.copyfileobj(img_req.raw, outfile, length=CHUNK_SIZE)
+    partial_file.replace(folder / asset_filename)
+
+
+def get_list_uid(unit_tag) -> str:
+    '''Grabs the unit's id from its unit list entry.'''
+    return unit_tag.select_one('span').text.strip().removeprefix("No.")
+
+
+def process_unit(unit_tag, asset_executor:Executor) -> None:
+    '''Downloads the profile and assets of the unit in a unit list entry.'''
+    uid = get_list_uid(unit_tag)
+
+    # Create a path to store unit data
+    unit_folder = SAVE_PATH / uid
+    unit_folder.mkdir(exist_ok=True)
+
+    # Skip existing entries
+    if (unit_folder / "data.json").exists():
+        LOG.warning("%s already exists. Brave Frontier unit skipped.", uid)
+        return
+
+    # Get url to the unit's profile
+    link_tag = unit_tag.select_one('a[href^="bf"]')
+    link_to_profile = urljoin(BASE_URL, link_tag.get("href"))
+
+    # Get unit icon from the unit list
+    unit_icon = None
+    unit_icon_tag = link_tag.select_one('img[src]')
+    if unit_icon_tag:
+        unit_icon = unit_icon_tag.get("src")
+
+    LOG.info("Downloading unit %s profile", uid)
+    unit = UnitPage.from_url(link_to_profile, session=SESSION, uid=uid, icon=unit_icon)
+
+    # Location for unit animations and images
+    unit_asset_folder = unit_folder / "assets"
+    unit_asset_folder.mkdir(exist_ok=True)
+
+    # Download the unit's animations and profile icon
+    LOG.info("Downloading unit %s assets.", uid)
+    url_list = [url for url in [unit.icon]+unit.animations if url is not None]
+    # Skip assets already downloaded by a previous run
+    url_list = [url for url in url_list if not (unit_asset_folder / Path(url).name).exists()]
+    futures = {asset_executor.submit(download_asset, url, unit_asset_folder): url for url in url_list}
+    failed = False
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except requests.HTTPError as e:
+            # The site does not have this asset, so retrying will not help.
+            # Transient errors (throttling, 5xx) still leave the unit to retry.
+            status = e.response.status_code if e.response is not None else None
+            if status is not None and status < 500 and status != 429:
+                LOG.warning("Asset %s of unit %s is unavailable (HTTP %s), skipped.", futures[future], uid, status)
+            else:
+                LOG.exception("Failed to download asset %s of unit %s", futures[future], uid)
+                failed = True
+        except Exception:
+            LOG.exception("Failed to download asset %s of unit %s", futures[future], uid)
+            failed = True
 
-        # Dump unit profile into folder
-        with (unit_folder / "data.json").open("w+", encoding="utf-8") as outfile:
-            outfile.write(json.dumps(unit.to_json(), indent=4, ensure_ascii=False))
+    if failed:
+        LOG.warning("Unit %s is incomplete and will be retried on the next run.", uid)
+        return
 
-        # Location for unit animations and images
-        unit_asset_folder = unit_folder / "assets"
-        unit_asset_folder.mkdir(exist_ok=True)
+    # Dump unit profile into folder last, so an interrupted unit is retried
+    (unit_folder / "data.json").write_bytes(orjson.dumps(unit.to_json(), option=orjson.OPT_INDENT_2))
 
-        # Download the unit's animations and profile icon
-        LOG.info(f"Downloading unit {uid} assets.")
-        url_list = [url for url in [unit.icon]+unit.animations if url is not None]
-        for url in url_list:
-            img_req = requests.get(url)
-            asset_filename = Path(url).name
+    LOG.info("Successfully donwloaded unit %s information.", unit.uid)
+    # print(orjson.dumps(unit.to_json(), option=orjson.OPT_INDENT_2).decode())
 
-            LOG.debug(f"Downloading <{asset_filename}> to: <{unit_asset_folder}>")
 
-            with (unit_asset_folder / asset_filename).open("wb+") as outfile:
-                outfile.write(img_req.content)
+def main() -> None:
 
-        LOG.info(f"Successfully donwloaded unit {unit.uid} information.")
-        # print(json.dumps(unit.to_json(), indent=4, ensure_ascii=False))
+    req = SESSION.get(BASE_URL)
+    req.raise_for_status()
+    resp = req.content
 
-    pass
+    _soup = BeautifulSoup(resp, "lxml")
+
+    # Get all tags for each Brave Frontier unit and scrape them concurrently
+    unit_tags = _soup.select('ul[class="unit_list"] > li')
+    # A single asset executor is shared by all units so the number of asset
+    # downloads in flight stays bounded
+    with ThreadPoolExecutor(max_workers=ASSET_WORKERS) as asset_executor, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(process_unit, unit_tag, asset_executor): get_list_uid(unit_tag)
+                   for unit_tag in unit_tags}
+        # Log every failed unit instead of stopping at the first one
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                LOG.exception("Failed to scrape unit %s", futures[future])
 
 
 if __name__ == '__main__':